@@ -1,6 +1,7 @@
 #!/usr/bin/python3
 import os
-from audioldm import text_to_audio, style_transfer, build_model, save_wave, get_time
+import sys
+from audioldm import text_to_audio, style_transfer, serve, build_model, save_wave, get_time
 import argparse
 
 CACHE_DIR = os.getenv(
@@ -14,8 +15,8 @@ parser.add_argument(
     type=str,
     required=False,
     default="generation",
-    help="generation: text-to-audio generation; transfer: style transfer",
-    choices=["generation", "transfer"]
+    help="generation: text-to-audio generation; transfer: style transfer; serve: keep the model loaded and generate for every JSON request read from stdin",
+    choices=["generation", "transfer", "serve"]
 )
 
 parser.add_argument(
@@ -141,6 +142,20 @@ n_candidate_gen_per_text = args.n_candidate_gen_per_text
 os.makedirs(save_path, exist_ok=True)
 audioldm = build_model(ckpt_path=args.ckpt_path)
 
+if(args.mode == "serve"):
+    # The command line options are the defaults of every request
+    serve(
+        audioldm,
+        save_path,
+        seed=random_seed,
+        duration=duration,
+        guidance_scale=guidance_scale,
+        ddim_steps=args.ddim_steps,
+        n_candidate_gen_per_text=n_candidate_gen_per_text,
+        batchsize=args.batchsize,
+    )
+    sys.exit(0)
+
 if(args.mode == "generation"):
     waveform = text_to_audio(
         audioldm,
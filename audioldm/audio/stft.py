@@ -64,12 +64,15 @@ class STFT(torch.nn.Module):
         )
         input_data = input_data.squeeze(1)
 
+        # cuDNN runs fp32 convolutions in TF32 on Ampere and newer by default, which
+        # drifts from the fp32 fbanks the model was trained on. Convolve in float64,
+        # which has no TF32 path, instead of changing the process-wide cuDNN flags.
         forward_transform = F.conv1d(
-            input_data,
-            torch.autograd.Variable(self.forward_basis, requires_grad=False),
+            input_data.double(),
+            torch.autograd.Variable(self.forward_basis.double(), requires_grad=False),
             stride=self.hop_length,
             padding=0,
-        ).cpu()
+        ).to(input_data.dtype)
 
         cutoff = int((self.filter_length / 2) + 1)
         real_part = forward_transform[:, :cutoff, :]
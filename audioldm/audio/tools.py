@@ -4,14 +4,14 @@ import torchaudio
 
 
 def get_mel_from_wav(audio, _stft):
-    audio = torch.clip(torch.FloatTensor(audio).unsqueeze(0), -1, 1)
+    # Run the STFT on whichever device _stft lives on, results stay there
+    audio = torch.as_tensor(audio, dtype=torch.float32, device=_stft.mel_basis.device)
+    audio = torch.clip(audio.unsqueeze(0), -1, 1)
     audio = torch.autograd.Variable(audio, requires_grad=False)
     melspec, log_magnitudes_stft, energy = _stft.mel_spectrogram(audio)
-    melspec = torch.squeeze(melspec, 0).numpy().astype(np.float32)
-    log_magnitudes_stft = (
-        torch.squeeze(log_magnitudes_stft, 0).numpy().astype(np.float32)
-    )
-    energy = torch.squeeze(energy, 0).numpy().astype(np.float32)
+    melspec = torch.squeeze(melspec, 0)
+    log_magnitudes_stft = torch.squeeze(log_magnitudes_stft, 0)
+    energy = torch.squeeze(energy, 0)
     return melspec, log_magnitudes_stft, energy
 
 
@@ -71,8 +71,8 @@ def wav_to_fbank(filename, target_length=1024, fn_STFT=None):
 
     fbank, log_magnitudes_stft, energy = get_mel_from_wav(waveform, fn_STFT)
 
-    fbank = torch.FloatTensor(fbank.T)
-    log_magnitudes_stft = torch.FloatTensor(log_magnitudes_stft.T)
+    fbank = fbank.T
+    log_magnitudes_stft = log_magnitudes_stft.T
 
     fbank, log_magnitudes_stft = _pad_spec(fbank, target_length), _pad_spec(
         log_magnitudes_stft, target_length
@@ -50,12 +50,21 @@ class CLAPAudioEmbeddingClassifierFreev2(nn.Module):
             p.requires_grad = False
 
         self.model.eval()
+        # Embedding of the empty prompt, a buffer so it follows the module across .to()
+        self.register_buffer("unconditional_token", None, persistent=False)
+
+    def get_unconditional_token(self):
+        # The embedding of the empty prompt is fixed for the frozen model, encode it once
+        if self.unconditional_token is None:
+            with torch.no_grad(), torch.autocast("cuda", enabled=False):
+                self.unconditional_token = self.model.get_text_embedding(
+                    self.tokenizer(["", ""])
+                )[0:1]
+        return self.unconditional_token
 
     def get_unconditional_condition(self, batchsize):
-        self.unconditional_token = self.model.get_text_embedding(
-            self.tokenizer(["", ""])
-        )[0:1]
-        return torch.cat([self.unconditional_token.unsqueeze(0)] * batchsize, dim=0)
+        unconditional_token = self.get_unconditional_token()
+        return torch.cat([unconditional_token.unsqueeze(0)] * batchsize, dim=0)
 
     def batch_to_list(self, batch):
         ret = []
@@ -113,6 +122,7 @@ class CLAPAudioEmbeddingClassifierFreev2(nn.Module):
             for p in self.model.parameters():
                 p.requires_grad = False
             self.model.eval()
+            self.unconditional_token = None
 
         # the 'fusion' truncate mode can be changed to 'rand_trunc' if run in unfusion mode
         if self.embed_mode == "audio":
@@ -141,19 +151,27 @@ class CLAPAudioEmbeddingClassifierFreev2(nn.Module):
                 # [bs, 512]
                 embed = self.model.get_audio_embedding(audio_dict_list)
         elif self.embed_mode == "text":
-            with torch.no_grad():
+            # Text embeddings are always computed in fp32, so the cached unconditional
+            # token does not depend on the autocast state of the first caller
+            with torch.no_grad(), torch.autocast("cuda", enabled=False):
                 # the 'fusion' truncate mode can be changed to 'rand_trunc' if run in unfusion mode
-                text_data = self.tokenizer(batch)
-                embed = self.model.get_text_embedding(text_data)
+                if self.unconditional_token is None:
+                    # Encode the empty prompt in the same forward pass as the text batch
+                    text_data = self.tokenizer(list(batch) + ["", ""])
+                    embed = self.model.get_text_embedding(text_data)
+                    # Clone so the cached token does not keep the whole batch alive
+                    self.unconditional_token = embed[-2:-1].clone()
+                    embed = embed[:-2]
+                else:
+                    text_data = self.tokenizer(batch)
+                    embed = self.model.get_text_embedding(text_data)
 
         embed = embed.unsqueeze(1)
-        self.unconditional_token = self.model.get_text_embedding(
-            self.tokenizer(["", ""])
-        )[0:1]
+        unconditional_token = self.get_unconditional_token()
 
         for i in range(embed.size(0)):
             if self.make_decision(self.unconditional_prob):
-                embed[i] = self.unconditional_token
+                embed[i] = unconditional_token
 
         # [bs, 1, 512]
         return embed.detach()
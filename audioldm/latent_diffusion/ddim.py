@@ -1,5 +1,7 @@
 """SAMPLING ONLY."""
 
+import threading
+
 import torch
 import numpy as np
 from tqdm import tqdm
@@ -12,22 +14,115 @@ from audioldm.latent_diffusion.util import (
 )
 
 
+def get_autocast_gpu_dtype():
+    # torch.get_autocast_gpu_dtype is deprecated since torch 2.4
+    if hasattr(torch, "get_autocast_dtype"):
+        return torch.get_autocast_dtype("cuda")
+    return torch.get_autocast_gpu_dtype()
+
+
+class CUDAGraphModelRunner(object):
+    """Replay the guided model output of a DDIM step from a captured CUDA graph.
+
+    The first call runs the model eagerly as warmup and captures the graph,
+    the following calls copy x and t into the static inputs and replay it.
+    The static buffers, conditioning included, outlive a sampling run so the
+    graph is reused by later runs with the same shapes in the same thread.
+    If capturing fails the runner remembers it, and runs with the same shapes
+    sample eagerly without trying again.
+    """
+
+    def __init__(self, sampler, unconditional_guidance_scale=1.0):
+        self.sampler = sampler
+        self.unconditional_guidance_scale = unconditional_guidance_scale
+        self.graph = None
+        self.capture_failed = False
+
+    def set_conditioning(self, cond, unconditional_conditioning=None):
+        if self.graph is None:
+            self.static_cond = cond.clone()
+            self.static_uc = None
+            if unconditional_conditioning is not None:
+                self.static_uc = unconditional_conditioning.clone()
+        else:
+            self.static_cond.copy_(cond)
+            if self.static_uc is not None:
+                self.static_uc.copy_(unconditional_conditioning)
+
+    def model_output(self, x, t):
+        return self.sampler.get_model_output(
+            x,
+            t,
+            self.static_cond,
+            unconditional_guidance_scale=self.unconditional_guidance_scale,
+            unconditional_conditioning=self.static_uc,
+        )
+
+    def capture(self, x, t):
+        # Capture into locals, the runner only holds a graph once capturing succeeded
+        static_x = x.clone()
+        static_t = t.clone()
+
+        # Warm up on a side stream before capturing
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            output = self.model_output(static_x, static_t)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_output = self.model_output(static_x, static_t)
+
+        self.static_x = static_x
+        self.static_t = static_t
+        self.static_output = static_output
+        self.graph = graph
+        return output
+
+    def __call__(self, x, t):
+        if self.capture_failed:
+            return self.model_output(x, t)
+        if self.graph is None:
+            try:
+                return self.capture(x, t)
+            except Exception as e:
+                print("Warning: Could not capture the CUDA graph, run the model eagerly: %s" % e)
+                self.capture_failed = True
+                return self.model_output(x, t)
+        self.static_x.copy_(x)
+        self.static_t.copy_(t)
+        self.graph.replay()
+        return self.static_output
+
+
 class DDIMSampler(object):
     def __init__(self, model, schedule="linear", **kwargs):
         super().__init__()
         self.model = model
         self.ddpm_num_timesteps = model.num_timesteps
         self.schedule = schedule
+        self.schedule_args = None
+        # Concurrent runs must not replay a graph into the same static buffers,
+        # so every thread keeps its own runner
+        self.cuda_graph_state = threading.local()
 
     def register_buffer(self, name, attr):
+        # Keep the schedule on the model device so sampling steps read it from there
+        if isinstance(attr, np.ndarray):
+            attr = torch.from_numpy(attr).to(torch.float32)
         if type(attr) == torch.Tensor:
-            if attr.device != torch.device("cuda"):
-                attr = attr.to(torch.device("cuda"))
+            attr = attr.to(device=self.model.device, dtype=torch.float32)
         setattr(self, name, attr)
 
     def make_schedule(
         self, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0.0, verbose=True
     ):
+        # The schedule only depends on these arguments, reuse it if they did not change
+        schedule_args = (ddim_num_steps, ddim_discretize, ddim_eta)
+        if self.schedule_args == schedule_args:
+            return
+
         self.ddim_timesteps = make_ddim_timesteps(
             ddim_discr_method=ddim_discretize,
             num_ddim_timesteps=ddim_num_steps,
@@ -84,6 +179,42 @@ class DDIMSampler(object):
         self.register_buffer(
             "ddim_sigmas_for_original_num_steps", sigmas_for_original_sampling_steps
         )
+        # Only mark the schedule as built once every buffer exists
+        self.schedule_args = schedule_args
+
+    def get_cuda_graph_runner(
+        self, x, cond, unconditional_guidance_scale, unconditional_conditioning
+    ):
+        # Reuse the captured graph and its static buffers while nothing it depends on changes
+        key = (
+            tuple(x.shape),
+            x.dtype,
+            tuple(cond.shape),
+            cond.dtype,
+            None
+            if unconditional_conditioning is None
+            else tuple(unconditional_conditioning.shape),
+            unconditional_guidance_scale,
+            torch.is_autocast_enabled(),
+            get_autocast_gpu_dtype(),
+            torch.is_inference_mode_enabled(),
+        )
+        state = self.cuda_graph_state
+        if getattr(state, "key", None) != key:
+            state.runner = CUDAGraphModelRunner(
+                self, unconditional_guidance_scale=unconditional_guidance_scale
+            )
+            state.key = key
+        if state.runner.capture_failed:
+            # Capturing already failed for this key, sample eagerly
+            return None
+        state.runner.set_conditioning(cond, unconditional_conditioning)
+        return state.runner
+
+    def reset_cuda_graph_runners(self):
+        # Drop the runners of all threads, a run in progress keeps its own until it ends.
+        # This releases the captured graphs and their memory pools.
+        self.cuda_graph_state = threading.local()
 
     @torch.no_grad()
     def sample(
@@ -109,6 +240,8 @@ class DDIMSampler(object):
         unconditional_guidance_scale=1.0,
         unconditional_conditioning=None,
         # this has to come in the same format as the conditioning, # e.g. as encoded tokens, ...
+        preview_fraction=1.0,
+        use_cuda_graph=False,
         **kwargs,
     ):
         if conditioning is not None:
@@ -145,6 +278,8 @@ class DDIMSampler(object):
             log_every_t=log_every_t,
             unconditional_guidance_scale=unconditional_guidance_scale,
             unconditional_conditioning=unconditional_conditioning,
+            preview_fraction=preview_fraction,
+            use_cuda_graph=use_cuda_graph,
         )
         return samples, intermediates
 
@@ -168,6 +303,8 @@ class DDIMSampler(object):
         corrector_kwargs=None,
         unconditional_guidance_scale=1.0,
         unconditional_conditioning=None,
+        preview_fraction=1.0,
+        use_cuda_graph=False,
     ):
         device = self.model.betas.device
         b = shape[0]
@@ -203,6 +340,15 @@ class DDIMSampler(object):
 
         # iterator = gr.Progress().tqdm(time_range, desc="DDIM Sampler", total=total_steps)
         iterator = tqdm(time_range, desc="DDIM Sampler", total=total_steps)
+        # With preview_fraction < 1, stop early and return the predicted x_0
+        stop_steps = max(1, int(preview_fraction * total_steps))
+
+        # Shapes are fixed across steps, so the model call can be replayed from a CUDA graph
+        model_output_fn = None
+        if use_cuda_graph and img.is_cuda and isinstance(cond, torch.Tensor):
+            model_output_fn = self.get_cuda_graph_runner(
+                img, cond, unconditional_guidance_scale, unconditional_conditioning
+            )
 
         for i, step in enumerate(iterator):
             index = total_steps - i - 1
@@ -229,6 +375,7 @@ class DDIMSampler(object):
                 corrector_kwargs=corrector_kwargs,
                 unconditional_guidance_scale=unconditional_guidance_scale,
                 unconditional_conditioning=unconditional_conditioning,
+                model_output_fn=model_output_fn,
             )
             img, pred_x0 = outs
             if callback:
@@ -240,6 +387,10 @@ class DDIMSampler(object):
                 intermediates["x_inter"].append(img)
                 intermediates["pred_x0"].append(pred_x0)
 
+            if i + 1 == stop_steps and stop_steps < total_steps:
+                img = pred_x0
+                break
+
         return img, intermediates
 
     @torch.no_grad()
@@ -270,6 +421,7 @@ class DDIMSampler(object):
         unconditional_guidance_scale=1.0,
         unconditional_conditioning=None,
         use_original_steps=False,
+        preview_fraction=1.0,
     ):
 
         timesteps = (
@@ -286,13 +438,15 @@ class DDIMSampler(object):
         # iterator = gr.Progress().tqdm(time_range, desc="Decoding image", total=total_steps)
         iterator = tqdm(time_range, desc="Decoding image", total=total_steps)
         x_dec = x_latent
+        # With preview_fraction < 1, stop early and return the predicted x_0
+        stop_steps = max(1, int(preview_fraction * total_steps))
 
         for i, step in enumerate(iterator):
             index = total_steps - i - 1
             ts = torch.full(
                 (x_latent.shape[0],), step, device=x_latent.device, dtype=torch.long
             )
-            x_dec, _ = self.p_sample_ddim(
+            x_dec, pred_x0 = self.p_sample_ddim(
                 x_dec,
                 cond,
                 ts,
@@ -301,8 +455,33 @@ class DDIMSampler(object):
                 unconditional_guidance_scale=unconditional_guidance_scale,
                 unconditional_conditioning=unconditional_conditioning,
             )
+            if i + 1 == stop_steps and stop_steps < total_steps:
+                x_dec = pred_x0
+                break
         return x_dec
 
+    @torch.no_grad()
+    def get_model_output(
+        self,
+        x,
+        t,
+        c,
+        unconditional_guidance_scale=1.0,
+        unconditional_conditioning=None,
+    ):
+        if unconditional_conditioning is None or unconditional_guidance_scale == 1.0:
+            e_t = self.model.apply_model(x, t, c)
+        else:
+            x_in = torch.cat([x] * 2)
+            t_in = torch.cat([t] * 2)
+            c_in = torch.cat([unconditional_conditioning, c])
+            e_t_uncond, e_t = self.model.apply_model(x_in, t_in, c_in).chunk(2)
+            # When unconditional_guidance_scale == 1: only e_t
+            # When unconditional_guidance_scale == 0: only unconditional
+            # When unconditional_guidance_scale > 1: add more unconditional guidance
+            e_t = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
+        return e_t
+
     @torch.no_grad()
     def p_sample_ddim(
         self,
@@ -319,20 +498,20 @@ class DDIMSampler(object):
         corrector_kwargs=None,
         unconditional_guidance_scale=1.0,
         unconditional_conditioning=None,
+        model_output_fn=None,
     ):
         b, *_, device = *x.shape, x.device
 
-        if unconditional_conditioning is None or unconditional_guidance_scale == 1.0:
-            e_t = self.model.apply_model(x, t, c)
+        if model_output_fn is not None:
+            e_t = model_output_fn(x, t)
         else:
-            x_in = torch.cat([x] * 2)
-            t_in = torch.cat([t] * 2)
-            c_in = torch.cat([unconditional_conditioning, c])
-            e_t_uncond, e_t = self.model.apply_model(x_in, t_in, c_in).chunk(2)
-            # When unconditional_guidance_scale == 1: only e_t
-            # When unconditional_guidance_scale == 0: only unconditional
-            # When unconditional_guidance_scale > 1: add more unconditional guidance
-            e_t = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
+            e_t = self.get_model_output(
+                x,
+                t,
+                c,
+                unconditional_guidance_scale=unconditional_guidance_scale,
+                unconditional_conditioning=unconditional_conditioning,
+            )
 
         if score_corrector is not None:
             assert self.model.parameterization == "eps"
@@ -357,12 +536,11 @@ class DDIMSampler(object):
             else self.ddim_sigmas
         )
         # select parameters corresponding to the currently considered timestep
-        a_t = torch.full((b, 1, 1, 1), alphas[index], device=device)
-        a_prev = torch.full((b, 1, 1, 1), alphas_prev[index], device=device)
-        sigma_t = torch.full((b, 1, 1, 1), sigmas[index], device=device)
-        sqrt_one_minus_at = torch.full(
-            (b, 1, 1, 1), sqrt_one_minus_alphas[index], device=device
-        )
+        # index the schedule on device and broadcast, torch.full would sync on every value
+        a_t = alphas[index].reshape(1, 1, 1, 1)
+        a_prev = alphas_prev[index].reshape(1, 1, 1, 1)
+        sigma_t = sigmas[index].reshape(1, 1, 1, 1)
+        sqrt_one_minus_at = sqrt_one_minus_alphas[index].reshape(1, 1, 1, 1)
 
         # current prediction for x_0
         pred_x0 = (x - sqrt_one_minus_at * e_t) / a_t.sqrt()
@@ -1,4 +1,6 @@
 import os
+import threading
+from collections import OrderedDict
 
 import torch
 import numpy as np
@@ -66,6 +68,10 @@ class LatentDiffusion(DDPM):
         self.instantiate_cond_stage(cond_stage_config)
         self.cond_stage_forward = cond_stage_forward
         self.clip_denoised = False
+        self.ddim_samplers = {}
+        self.ddim_sampler_lock = threading.Lock()
+        # First stage posteriors of audio files, filled by the style transfer pipeline
+        self.encoded_audio_cache = OrderedDict()
 
     def make_cond_schedule(
         self,
@@ -233,15 +239,39 @@ class LatentDiffusion(DDPM):
         z = 1.0 / self.scale_factor * z
         return self.first_stage_model.decode(z)
 
-    def mel_spectrogram_to_waveform(self, mel):
+    def mel_spectrogram_to_waveform(self, mel, to_numpy=True):
         # Mel: [bs, 1, t-steps, fbins]
         if len(mel.size()) == 4:
             mel = mel.squeeze(1)
         mel = mel.permute(0, 2, 1)
         waveform = self.first_stage_model.vocoder(mel)
-        waveform = waveform.cpu().detach().numpy()
+        if to_numpy:
+            waveform = self.waveform_to_numpy(waveform)
         return waveform
 
+    def waveform_to_numpy(self, waveform):
+        # numpy has no bfloat16, cast back in case we ran under autocast
+        return waveform.float().cpu().detach().numpy()
+
+    def select_best_candidates(self, waveform, text, n_text):
+        # Rank the candidates on device, only the selected ones are copied to host
+        if waveform.shape[0] > 1:
+            similarity = self.cond_stage_model.cos_similarity(
+                waveform.float().squeeze(1), text
+            )
+
+            best_index = []
+            for i in range(n_text):
+                candidates = similarity[i :: n_text]
+                max_index = torch.argmax(candidates).item()
+                best_index.append(i + max_index * n_text)
+
+            waveform = waveform[best_index]
+            # print("Similarity between generated audio and text", similarity)
+            # print("Choose the following indexes:", best_index)
+
+        return self.waveform_to_numpy(waveform)
+
     @torch.no_grad()
     def encode_first_stage(self, x):
         return self.first_stage_model.encode(x)
@@ -581,6 +611,28 @@ class LatentDiffusion(DDPM):
             **kwargs,
         )
 
+    def get_ddim_sampler(self, ddim_steps, ddim_eta=0.0, ddim_discretize="uniform"):
+        # Keep one sampler per schedule, so a call never rebuilds the schedule
+        # another call is still sampling with
+        key = (ddim_steps, ddim_discretize, ddim_eta)
+        with self.ddim_sampler_lock:
+            if key not in self.ddim_samplers:
+                ddim_sampler = DDIMSampler(self)
+                ddim_sampler.make_schedule(
+                    ddim_num_steps=ddim_steps,
+                    ddim_discretize=ddim_discretize,
+                    ddim_eta=ddim_eta,
+                    verbose=False,
+                )
+                self.ddim_samplers[key] = ddim_sampler
+            return self.ddim_samplers[key]
+
+    def release_cuda_graphs(self):
+        # Captured CUDA graphs hold a private memory pool per worker thread, free them
+        with self.ddim_sampler_lock:
+            for ddim_sampler in self.ddim_samplers.values():
+                ddim_sampler.reset_cuda_graph_runners()
+
     @torch.no_grad()
     def sample_log(
         self,
@@ -592,6 +644,9 @@ class LatentDiffusion(DDPM):
         unconditional_conditioning=None,
         use_plms=False,
         mask=None,
+        preview_fraction=1.0,
+        use_cuda_graph=False,
+        autocast_dtype=None,
         **kwargs,
     ):
 
@@ -601,33 +656,43 @@ class LatentDiffusion(DDPM):
             shape = (self.channels, self.latent_t_size, self.latent_f_size)
 
         intermediate = None
-        if ddim and not use_plms:
-            # print("Use ddim sampler")
-
-            ddim_sampler = DDIMSampler(self)
-            samples, intermediates = ddim_sampler.sample(
-                ddim_steps,
-                batch_size,
-                shape,
-                cond,
-                verbose=False,
-                unconditional_guidance_scale=unconditional_guidance_scale,
-                unconditional_conditioning=unconditional_conditioning,
-                mask=mask,
-                **kwargs,
-            )
+        # Only the denoising loop runs in reduced precision, decoding and vocoding stay in fp32.
+        # The autocast weight cache cannot be used while capturing a CUDA graph.
+        with torch.autocast(
+            "cuda",
+            dtype=autocast_dtype,
+            enabled=autocast_dtype is not None,
+            cache_enabled=not use_cuda_graph,
+        ):
+            if ddim and not use_plms:
+                # print("Use ddim sampler")
+
+                ddim_sampler = self.get_ddim_sampler(ddim_steps, kwargs.get("eta", 0.0))
+                samples, intermediates = ddim_sampler.sample(
+                    ddim_steps,
+                    batch_size,
+                    shape,
+                    cond,
+                    verbose=False,
+                    unconditional_guidance_scale=unconditional_guidance_scale,
+                    unconditional_conditioning=unconditional_conditioning,
+                    mask=mask,
+                    preview_fraction=preview_fraction,
+                    use_cuda_graph=use_cuda_graph,
+                    **kwargs,
+                )
 
-        else:
-            # print("Use DDPM sampler")
-            samples, intermediates = self.sample(
-                cond=cond,
-                batch_size=batch_size,
-                return_intermediates=True,
-                unconditional_guidance_scale=unconditional_guidance_scale,
-                mask=mask,
-                unconditional_conditioning=unconditional_conditioning,
-                **kwargs,
-            )
+            else:
+                # print("Use DDPM sampler")
+                samples, intermediates = self.sample(
+                    cond=cond,
+                    batch_size=batch_size,
+                    return_intermediates=True,
+                    unconditional_guidance_scale=unconditional_guidance_scale,
+                    mask=mask,
+                    unconditional_conditioning=unconditional_conditioning,
+                    **kwargs,
+                )
 
         return samples, intermediate
 
@@ -644,6 +709,9 @@ class LatentDiffusion(DDPM):
         name="waveform",
         use_plms=False,
         save=False,
+        preview_fraction=1.0,
+        use_cuda_graph=False,
+        autocast_dtype=None,
         **kwargs,
     ):
         # Generate n_candidate_gen_per_text times and select the best
@@ -663,19 +731,24 @@ class LatentDiffusion(DDPM):
 
         with self.ema_scope("Generate"):
             for batch in batchs:
-                z, c = self.get_input(
+                # The fbank in the batch is only a placeholder, skip encoding it.
+                # Sampling its posterior used to draw from the RNG, so a given seed
+                # generates different audio than before this was skipped.
+                _, c = self.get_input(
                     batch,
                     self.first_stage_key,
                     cond_key=self.cond_stage_key,
+                    return_first_stage_encode=False,
                     return_first_stage_outputs=False,
                     force_c_encode=True,
                     return_original_cond=False,
                     bs=None,
                 )
                 text = super().get_input(batch, "text")
+                n_text = len(text)
 
                 # Generate multiple samples
-                batch_size = z.shape[0] * n_candidate_gen_per_text
+                batch_size = n_text * n_candidate_gen_per_text
                 c = torch.cat([c] * n_candidate_gen_per_text, dim=0)
                 text = text * n_candidate_gen_per_text
 
@@ -694,26 +767,15 @@ class LatentDiffusion(DDPM):
                     unconditional_guidance_scale=unconditional_guidance_scale,
                     unconditional_conditioning=unconditional_conditioning,
                     use_plms=use_plms,
+                    preview_fraction=preview_fraction,
+                    use_cuda_graph=use_cuda_graph,
+                    autocast_dtype=autocast_dtype,
                 )
 
                 mel = self.decode_first_stage(samples)
 
-                waveform = self.mel_spectrogram_to_waveform(mel)
-
-                if waveform.shape[0] > 1:
-                    similarity = self.cond_stage_model.cos_similarity(
-                        torch.FloatTensor(waveform).squeeze(1), text
-                    )
-
-                    best_index = []
-                    for i in range(z.shape[0]):
-                        candidates = similarity[i :: z.shape[0]]
-                        max_index = torch.argmax(candidates).item()
-                        best_index.append(i + max_index * z.shape[0])
-
-                    waveform = waveform[best_index]
-                    # print("Similarity between generated audio and text", similarity)
-                    # print("Choose the following indexes:", best_index)
+                waveform = self.mel_spectrogram_to_waveform(mel, to_numpy=False)
+                waveform = self.select_best_candidates(waveform, text, n_text)
 
         return waveform
 
@@ -732,6 +794,7 @@ class LatentDiffusion(DDPM):
         time_mask_ratio_start_and_end=(0.25, 0.75),
         freq_mask_ratio_start_and_end=(0.75, 1.0),
         save=False,
+        autocast_dtype=None,
         **kwargs,
     ):
         # Generate n_candidate_gen_per_text times and select the best
@@ -790,26 +853,13 @@ class LatentDiffusion(DDPM):
                     eta=ddim_eta,
                     unconditional_guidance_scale=unconditional_guidance_scale,
                     unconditional_conditioning=unconditional_conditioning,
-                    use_plms=use_plms, mask=mask, x0=torch.cat([z] * n_candidate_gen_per_text)
+                    use_plms=use_plms, mask=mask, x0=torch.cat([z] * n_candidate_gen_per_text),
+                    autocast_dtype=autocast_dtype,
                 )
 
                 mel = self.decode_first_stage(samples)
 
-                waveform = self.mel_spectrogram_to_waveform(mel)
-
-                if waveform.shape[0] > 1:
-                    similarity = self.cond_stage_model.cos_similarity(
-                        torch.FloatTensor(waveform).squeeze(1), text
-                    )
-
-                    best_index = []
-                    for i in range(z.shape[0]):
-                        candidates = similarity[i :: z.shape[0]]
-                        max_index = torch.argmax(candidates).item()
-                        best_index.append(i + max_index * z.shape[0])
-
-                    waveform = waveform[best_index]
-                    # print("Similarity between generated audio and text", similarity)
-                    # print("Choose the following indexes:", best_index)
+                waveform = self.mel_spectrogram_to_waveform(mel, to_numpy=False)
+                waveform = self.select_best_candidates(waveform, text, z.shape[0])
 
         return waveform
\ No newline at end of file
@@ -1,4 +1,10 @@
 import os
+import sys
+import copy
+import json
+import pickle
+import functools
+from dataclasses import dataclass
 
 import argparse
 import yaml
@@ -6,34 +12,37 @@ import torch
 from torch import autocast
 from tqdm import tqdm, trange
 
-from audioldm import LatentDiffusion, seed_everything
+from audioldm import LatentDiffusion, seed_everything, save_wave, get_time
 from audioldm.utils import default_audioldm_config
 from audioldm.audio import wav_to_fbank, TacotronSTFT, read_wav_file
-from audioldm.latent_diffusion.ddim import DDIMSampler
-from einops import repeat
+from audioldm.variational_autoencoder.distributions import DiagonalGaussianDistribution
 
 CACHE_DIR = os.getenv(
     "AUDIOLDM_CACHE_DIR",
     os.path.join(os.path.expanduser("~"), ".cache/audioldm"))
 
+# Number of source audio files whose VAE posterior style_transfer keeps per model
+ENCODED_AUDIO_CACHE_SIZE = 8
+
 def make_batch_for_text_to_audio(text, waveform=None, fbank=None, batchsize=1):
     text = [text] * batchsize
     if batchsize < 1:
         print("Warning: Batchsize must be at least 1. Batchsize is set to .")
     
     if(fbank is None):
-        fbank = torch.zeros((batchsize, 1024, 64))  # Not used, here to keep the code format
+        fbank = torch.empty((batchsize, 1024, 64))  # Not used, here to keep the code format
     else:
-        fbank = torch.FloatTensor(fbank)
+        # as_tensor avoids a copy for float32 inputs, expand gives a stride-0 view
+        fbank = torch.as_tensor(fbank, dtype=torch.float32)
         fbank = fbank.expand(batchsize, 1024, 64)
         assert fbank.size(0) == batchsize
         
-    stft = torch.zeros((batchsize, 1024, 512))  # Not used
+    stft = torch.empty((batchsize, 1024, 512))  # Not used
 
     if(waveform is None):
-        waveform = torch.zeros((batchsize, 160000))  # Not used
+        waveform = torch.empty((batchsize, 160000))  # Not used
     else:
-        waveform = torch.FloatTensor(waveform)
+        waveform = torch.as_tensor(waveform, dtype=torch.float32)
         waveform = waveform.expand(batchsize, -1)
         assert waveform.size(0) == batchsize
         
@@ -50,18 +59,84 @@ def make_batch_for_text_to_audio(text, waveform=None, fbank=None, batchsize=1):
     return batch
 
 
-def build_model(
-    ckpt_path=os.path.join(CACHE_DIR, "audioldm-s-full.ckpt"),
-    config=None,
-):
+@functools.lru_cache(maxsize=4)
+def _load_config(config_path):
+    return yaml.load(open(config_path, "r"), Loader=yaml.FullLoader)
+
+@dataclass(frozen=True)
+class STFTParams:
+    filter_length: int
+    hop_length: int
+    win_length: int
+    n_mel_channels: int
+    sampling_rate: int
+    mel_fmin: float
+    mel_fmax: float
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            filter_length=config["preprocessing"]["stft"]["filter_length"],
+            hop_length=config["preprocessing"]["stft"]["hop_length"],
+            win_length=config["preprocessing"]["stft"]["win_length"],
+            n_mel_channels=config["preprocessing"]["mel"]["n_mel_channels"],
+            sampling_rate=config["preprocessing"]["audio"]["sampling_rate"],
+            mel_fmin=config["preprocessing"]["mel"]["mel_fmin"],
+            mel_fmax=config["preprocessing"]["mel"]["mel_fmax"],
+        )
+
+@functools.lru_cache(maxsize=4)
+def _get_fn_STFT(stft_params, device):
+    # Building the mel filterbank and fourier basis is costly, reuse them across calls.
+    # The buffers live on device so the STFT runs there as a single batched conv.
+    return TacotronSTFT(
+        stft_params.filter_length,
+        stft_params.hop_length,
+        stft_params.win_length,
+        stft_params.n_mel_channels,
+        stft_params.sampling_rate,
+        stft_params.mel_fmin,
+        stft_params.mel_fmax,
+    ).to(device)
+
+def _torch_load(ckpt_path, mmap):
+    try:
+        # weights_only skips the full pickle VM
+        return torch.load(ckpt_path, map_location="cpu", mmap=mmap, weights_only=True)
+    except pickle.UnpicklingError as e:
+        # Some checkpoints store non-tensor objects, ask for the full unpickle
+        # explicitly as weights_only defaults to True since torch 2.6
+        print(
+            "Warning: %s is not a weights-only checkpoint, unpickle it fully. Only load checkpoints you trust: %s"
+            % (ckpt_path, e)
+        )
+        return torch.load(ckpt_path, map_location="cpu", mmap=mmap, weights_only=False)
+
+def _load_ckpt(ckpt_path):
+    try:
+        # mmap maps the file instead of reading it into RAM
+        checkpoint = _torch_load(ckpt_path, mmap=True)
+    except TypeError:
+        # torch < 2.1 has no mmap, its torch.load does a full unpickle by default
+        checkpoint = torch.load(ckpt_path, map_location="cpu")
+    except RuntimeError as e:
+        # Legacy (non-zipfile) checkpoints cannot be mapped, read those into RAM
+        if "mmap" not in str(e):
+            raise
+        checkpoint = _torch_load(ckpt_path, mmap=False)
+    # Only the weights are needed for inference, drop optimizer/scheduler states
+    return checkpoint["state_dict"]
+
+@functools.lru_cache(maxsize=1)
+def _build_model(ckpt_path, config):
     if torch.cuda.is_available():
         device = torch.device("cuda:0")
     else:
         device = torch.device("cpu")
 
     if config is not None:
-        assert type(config) is str
-        config = yaml.load(open(config, "r"), Loader=yaml.FullLoader)
+        # The parsed yaml is cached, copy it before setting the device below
+        config = copy.deepcopy(_load_config(config))
     else:
         config = default_audioldm_config()
 
@@ -74,8 +149,7 @@ def build_model(
 
     resume_from_checkpoint = ckpt_path
 
-    checkpoint = torch.load(resume_from_checkpoint, map_location=device)
-    latent_diffusion.load_state_dict(checkpoint["state_dict"])
+    latent_diffusion.load_state_dict(_load_ckpt(resume_from_checkpoint))
 
     latent_diffusion.eval()
     latent_diffusion = latent_diffusion.to(device)
@@ -83,6 +157,34 @@ def build_model(
     latent_diffusion.cond_stage_model.embed_mode = "text"
     return latent_diffusion
 
+def build_model(
+    ckpt_path=os.path.join(CACHE_DIR, "audioldm-s-full.ckpt"),
+    config=None,
+):
+    # The most recently built model is memoized on (ckpt_path, config), so
+    # repeated calls return the same instance instead of reloading the checkpoint.
+    # Use build_model.cache_clear() to release it.
+    # Every caller shares that instance, including the state the pipeline functions
+    # keep on it: latent_t_size, embed_mode, the DDIM sampler and the encoded audio cache.
+    if config is not None:
+        assert type(config) is str
+        config = os.path.abspath(config)
+    return _build_model(os.path.abspath(ckpt_path), config)
+
+build_model.cache_clear = _build_model.cache_clear
+
+def _autocast_dtype(use_autocast=True):
+    # bf16 keeps the fp32 exponent range. is_bf16_supported() also counts emulated bf16,
+    # which is slower than fp32, so require native support (Ampere and newer).
+    # Everywhere else sample in fp32.
+    if (
+        use_autocast
+        and torch.cuda.is_available()
+        and torch.cuda.get_device_capability() >= (8, 0)
+    ):
+        return torch.bfloat16
+    return None
+
 def duration_to_latent_t_size(duration):
     return int(duration * 25.6)
 
@@ -107,6 +209,9 @@ def text_to_audio(
     guidance_scale=2.5,
     n_candidate_gen_per_text=3,
     config=None,
+    preview_fraction=1.0,
+    use_cuda_graph=False,
+    use_autocast=True,
 ):
     seed_everything(int(seed))
     
@@ -125,16 +230,59 @@ def text_to_audio(
         print("Generate audio using text %s" % text)
         latent_diffusion = set_cond_text(latent_diffusion)
         
-    with torch.no_grad():
+    with torch.inference_mode():
         waveform = latent_diffusion.generate_sample(
             [batch],
             unconditional_guidance_scale=guidance_scale,
             ddim_steps=ddim_steps,
             n_candidate_gen_per_text=n_candidate_gen_per_text,
             duration=duration,
+            preview_fraction=preview_fraction,
+            use_cuda_graph=use_cuda_graph,
+            autocast_dtype=_autocast_dtype(use_autocast),
         )
     return waveform
 
+def _encode_audio_file(latent_diffusion, audio_file_path, duration, stft_params, device):
+    # Reading, STFT and VAE encoding are deterministic in the file content (tracked
+    # through inode, size and mtime_ns, as a copy can keep the mtime), so transferring
+    # the same audio again skips all of them.
+    # The cache lives on the model, so it is released together with the model.
+    cache = latent_diffusion.encoded_audio_cache
+    stat = os.stat(audio_file_path)
+    key = (
+        audio_file_path,
+        stat.st_ino,
+        stat.st_size,
+        stat.st_mtime_ns,
+        duration,
+        stft_params,
+        device,
+    )
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+
+    fn_STFT = _get_fn_STFT(stft_params, device)
+
+    mel, _, _ = wav_to_fbank(
+        audio_file_path, target_length=int(duration * 102.4), fn_STFT=fn_STFT
+    )
+    mel = mel.unsqueeze(0).unsqueeze(0).to(device)
+    cache[key] = latent_diffusion.encode_first_stage(mel)
+    while len(cache) > ENCODED_AUDIO_CACHE_SIZE:
+        cache.popitem(last=False)
+    return cache[key]
+
+def _get_text_conditioning(latent_diffusion, prompts, batchsize, guidance_scale):
+    # The text forward also encodes the empty prompt, so uc is served from cache
+    c = latent_diffusion.get_learned_conditioning([prompts] * batchsize)
+
+    uc = None
+    if guidance_scale != 1.0:
+        uc = latent_diffusion.cond_stage_model.get_unconditional_condition(batchsize)
+    return c, uc
+
 def style_transfer(
     latent_diffusion,
     text,
@@ -146,6 +294,7 @@ def style_transfer(
     guidance_scale=2.5,
     ddim_steps=200,
     config=None,
+    preview_fraction=1.0,
 ):
     if torch.cuda.is_available():
         device = torch.device("cuda:0")
@@ -156,7 +305,7 @@ def style_transfer(
 
     if config is not None:
         assert type(config) is str
-        config = yaml.load(open(config, "r"), Loader=yaml.FullLoader)
+        config = _load_config(config)
     else:
         config = default_audioldm_config()
 
@@ -164,45 +313,54 @@ def style_transfer(
     latent_diffusion.latent_t_size = duration_to_latent_t_size(duration)
     latent_diffusion.cond_stage_model.embed_mode = "text"
 
-    fn_STFT = TacotronSTFT(
-        config["preprocessing"]["stft"]["filter_length"],
-        config["preprocessing"]["stft"]["hop_length"],
-        config["preprocessing"]["stft"]["win_length"],
-        config["preprocessing"]["mel"]["n_mel_channels"],
-        config["preprocessing"]["audio"]["sampling_rate"],
-        config["preprocessing"]["mel"]["mel_fmin"],
-        config["preprocessing"]["mel"]["mel_fmax"],
+    posterior = _encode_audio_file(
+        latent_diffusion,
+        original_audio_file_path,
+        duration,
+        STFTParams.from_config(config),
+        device,
     )
-
-    mel, _, _ = wav_to_fbank(
-        original_audio_file_path, target_length=int(duration * 102.4), fn_STFT=fn_STFT
+    # Every batch item encodes the same mel, so expand the posterior and only sample per item
+    posterior = DiagonalGaussianDistribution(
+        posterior.parameters.expand(batchsize, -1, -1, -1)
     )
-    mel = mel.unsqueeze(0).unsqueeze(0).to(device)
-    mel = repeat(mel, "1 ... -> b ...", b=batchsize)
     init_latent = latent_diffusion.get_first_stage_encoding(
-        latent_diffusion.encode_first_stage(mel)
+        posterior
     )  # move to latent space, encode and sample
 
-    sampler = DDIMSampler(latent_diffusion)
-    sampler.make_schedule(ddim_num_steps=ddim_steps, ddim_eta=1.0, verbose=False)
+    sampler = latent_diffusion.get_ddim_sampler(ddim_steps, ddim_eta=1.0)
 
     t_enc = int(transfer_strength * ddim_steps)
+    t_enc_batch = torch.full((batchsize,), t_enc, device=device, dtype=torch.long)
     prompts = text
 
-    with torch.no_grad():
+    with torch.inference_mode():
         with autocast("cuda"):
             with latent_diffusion.ema_scope():
-                uc = None
-                if guidance_scale != 1.0:
-                    uc = latent_diffusion.cond_stage_model.get_unconditional_condition(
-                        batchsize
+                if device.type == "cuda":
+                    # The conditioning and z_enc are independent, overlap them on two streams
+                    current_stream = torch.cuda.current_stream()
+                    cond_stream, encode_stream = torch.cuda.Stream(), torch.cuda.Stream()
+                    cond_stream.wait_stream(current_stream)
+                    encode_stream.wait_stream(current_stream)
+
+                    with torch.cuda.stream(cond_stream):
+                        c, uc = _get_text_conditioning(
+                            latent_diffusion, prompts, batchsize, guidance_scale
+                        )
+                    with torch.cuda.stream(encode_stream):
+                        z_enc = sampler.stochastic_encode(init_latent, t_enc_batch)
+
+                    current_stream.wait_stream(cond_stream)
+                    current_stream.wait_stream(encode_stream)
+                    for tensor in (c, uc, z_enc):
+                        if tensor is not None:
+                            tensor.record_stream(current_stream)
+                else:
+                    c, uc = _get_text_conditioning(
+                        latent_diffusion, prompts, batchsize, guidance_scale
                     )
-
-                c = latent_diffusion.get_learned_conditioning([prompts] * batchsize)
-
-                z_enc = sampler.stochastic_encode(
-                    init_latent, torch.tensor([t_enc] * batchsize).to(device)
-                )
+                    z_enc = sampler.stochastic_encode(init_latent, t_enc_batch)
 
                 samples = sampler.decode(
                     z_enc,
@@ -210,6 +368,7 @@ def style_transfer(
                     t_enc,
                     unconditional_guidance_scale=guidance_scale,
                     unconditional_conditioning=uc,
+                    preview_fraction=preview_fraction,
                 )
 
                 x_samples = latent_diffusion.decode_first_stage(samples)
@@ -235,22 +394,15 @@ def super_resolution_and_inpainting(
     # freq_mask_ratio_start_and_end=(0.75, 1.0), # regenerate the higher 75% to 100% mel bins
     freq_mask_ratio_start_and_end=(1.0, 1.0), # no super-resolution
     config=None,
+    use_autocast=True,
 ):
     seed_everything(int(seed))
     if config is not None:
         assert type(config) is str
-        config = yaml.load(open(config, "r"), Loader=yaml.FullLoader)
+        config = _load_config(config)
     else:
         config = default_audioldm_config()
-    fn_STFT = TacotronSTFT(
-        config["preprocessing"]["stft"]["filter_length"],
-        config["preprocessing"]["stft"]["hop_length"],
-        config["preprocessing"]["stft"]["win_length"],
-        config["preprocessing"]["mel"]["n_mel_channels"],
-        config["preprocessing"]["audio"]["sampling_rate"],
-        config["preprocessing"]["mel"]["mel_fmin"],
-        config["preprocessing"]["mel"]["mel_fmax"],
-    )
+    fn_STFT = _get_fn_STFT(STFTParams.from_config(config), latent_diffusion.device)
     
     # waveform = read_wav_file(original_audio_file_path, None)
     mel, _, _ = wav_to_fbank(
@@ -262,7 +414,7 @@ def super_resolution_and_inpainting(
     # latent_diffusion.latent_t_size = duration_to_latent_t_size(duration)
     latent_diffusion = set_cond_text(latent_diffusion)
         
-    with torch.no_grad():
+    with torch.inference_mode():
         waveform = latent_diffusion.generate_sample_masked(
             [batch],
             unconditional_guidance_scale=guidance_scale,
@@ -270,6 +422,29 @@ def super_resolution_and_inpainting(
             n_candidate_gen_per_text=n_candidate_gen_per_text,
             duration=duration,
             time_mask_ratio_start_and_end=time_mask_ratio_start_and_end,
-            freq_mask_ratio_start_and_end=freq_mask_ratio_start_and_end
+            freq_mask_ratio_start_and_end=freq_mask_ratio_start_and_end,
+            autocast_dtype=_autocast_dtype(use_autocast),
         )
-    return waveform
\ No newline at end of file
+    return waveform
+
+def serve(latent_diffusion, save_path="./output/serve", input_stream=None, **kwargs):
+    # Keep the model loaded and generate audio for every request read from
+    # input_stream (stdin by default), one JSON object per line, e.g.
+    #   {"text": "A hammer is hitting a wooden surface", "duration": 5, "seed": 0}
+    # Other keys are passed to text_to_audio and override the defaults in kwargs.
+    if input_stream is None:
+        input_stream = sys.stdin
+
+    os.makedirs(save_path, exist_ok=True)
+    for line in input_stream:
+        line = line.strip()
+        if len(line) == 0:
+            continue
+        try:
+            request = dict(kwargs, **json.loads(line))
+            text = request.pop("text", "")
+            waveform = text_to_audio(latent_diffusion, text, **request)
+            save_wave(waveform, save_path, name="%s_%s" % (get_time(), text))
+        except Exception as e:
+            print("Error: Failed to process request %s: %s" % (line, e))
+        sys.stdout.flush()